@@ -18,6 +18,8 @@ from .nio_client import AppserviceClient, RequestException
 
 USER_MXID = str
 THROTTLE_DURATION = dt.timedelta(hours=1)
+# event types `handle_matrix_event` acts on, others are dropped anyway
+HANDLED_EVENT_TYPES = {"m.room.member", "m.room.message"}
 
 OAUTH_INSTRUCTIONS = """
 Usage:
@@ -379,7 +381,13 @@ class UserBridge:
 			await self.nc.invite_and_join_room(mxid=self.nc.appservice_id, room_id=room_id, as_bot=event.state_key)
 
 	async def _replay_matrix_events(self, room_id: str, since_event_id: str):
-		for event in await self.nc.get_old_events(room_id, since_event_id, flexible_visibility=True):
+		old_events = await self.nc.get_old_events(
+			room_id,
+			since_event_id,
+			flexible_visibility=True,
+			event_types=HANDLED_EVENT_TYPES,
+		)
+		for event in old_events:
 			await self.handle_matrix_event(event)
 
 	def _is_valid_bot_mxid(self, mxid: str) -> bool:
@@ -436,12 +444,10 @@ class UserBridge:
 				name=mail.content.subject,
 			)
 			assert isinstance(r, nio.RoomCreateResponse), r
-			for b in bots:
-				await self.nc.join_room(r.room_id, as_bot=b)
+			await aio.gather(*[self.nc.join_room(r.room_id, as_bot=b) for b in bots])
 			room_id = r.room_id
 		else:
-			for b in bots:
-				await self.nc.invite_and_join_room(b, room_id)
+			await aio.gather(*[self.nc.invite_and_join_room(b, room_id) for b in bots])
 			await self.nc.set_room_power_levels(room_id, power_levels=powers)
 
 		sender_mxid = self._generate_bot_mxid(mail.sender)
@@ -1,5 +1,8 @@
 from .prelude import *
-from typing import Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Iterator, Optional
 import yaml
 from pydantic import BaseSettings, Field
 import base64
@@ -56,6 +59,11 @@ class BridgeConfig(BaseSettings):
 		default="http://localhost:8008",
 	)
 
+	HOMESERVER_GZIP_REQUESTS: bool = Field(
+		description="gzip large request bodies sent to homeserver. Only enable if homeserver (or proxy in front of it) accepts gzip encoded requests",
+		default=False,
+	)
+
 	ADMIN_USER: str = Field(
 		description="url by which bridge can access homeserver",
 		default="http://localhost:8008",
@@ -138,6 +146,12 @@ namespaces:
 
 	@classmethod
 	def example_config(cls) -> 'BridgeConfig':
+		# hand out copies, so callers can't mutate the cached instance
+		return cls._example_config().copy()
+
+	@classmethod
+	@lru_cache(maxsize=None)
+	def _example_config(cls) -> 'BridgeConfig':
 		body = {}
 		props = cls.schema()['properties']
 		for name, field in props.items():
@@ -151,10 +165,15 @@ namespaces:
 
 # to support overrride in tests
 _runtime_config_override: Optional[BridgeConfig] = None
+# scoped override, so concurrent tests (tasks) can each use their own config. Takes precedence over the global one
+_config_override: ContextVar[Optional[BridgeConfig]] = ContextVar("config_override", default=None)
 
 
 def get_config() -> BridgeConfig:
-	if _runtime_config_override is not None:
+	override = _config_override.get()
+	if override is not None:
+		return override
+	elif _runtime_config_override is not None:
 		return _runtime_config_override
 	else:
 		if CONFIG_PATH.exists():
@@ -165,6 +184,16 @@ def get_config() -> BridgeConfig:
 			)
 
 
-def override_config(config: BridgeConfig):
+@contextmanager
+def overridden_config(config: BridgeConfig) -> Iterator[BridgeConfig]:
+	token = _config_override.set(config)
+	try:
+		yield config
+	finally:
+		_config_override.reset(token)
+
+
+def override_config(config: Optional[BridgeConfig]):
+	""" process wide override, see `overridden_config` for a scoped one """
 	global _runtime_config_override
 	_runtime_config_override = config
@@ -7,6 +7,7 @@ from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from functools import cached_property
 from typing import *
 
 import aiogoogle as _aiogoogle
@@ -18,7 +19,7 @@ from httpx_oauth.oauth2 import GetAccessTokenError
 from pydantic import BaseModel, Field
 from structlog import BoundLogger
 
-from app.utils import NamedTempFile
+from app.utils import named_temp_path
 
 from . import utils as u
 from .log import Logger
@@ -231,7 +232,7 @@ class GmailClient:
 			)
 			return await self.ag.as_user(req)
 
-		with NamedTempFile() as path:
+		with named_temp_path() as path:
 			path.write_bytes(message.as_bytes())
 			req = self.service.users.messages.send( # type: ignore
 				userId='me', # type: ignore
@@ -329,10 +330,11 @@ class GoogleAuth:
 	Simple wrapper for httpx_oauth.GoogleOAuth2 that works with `Token` class
 	"""
 	service_key: ServiceKey
-	oauth_client: GoogleOAuth2 = field(init=False)
 
-	def __post_init__(self):
-		self.oauth_client = GoogleOAuth2(
+	@cached_property
+	def oauth_client(self) -> GoogleOAuth2:
+		# lazy, most dm commands never reach the oauth flow
+		return GoogleOAuth2(
 			self.service_key.client_id,
 			self.service_key.client_secret,
 		)
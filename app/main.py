@@ -54,6 +54,7 @@ class AppState:
 			homeserver_url=config.HOMESERVER_URL,
 			homeserver_name=config.HOMESERVER_NAME,
 			namespace_prefix=config.NAMESPACE_PREFIX,
+			gzip_requests=config.HOMESERVER_GZIP_REQUESTS,
 		)
 		appservice = self.appservice
 
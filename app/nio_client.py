@@ -1,18 +1,21 @@
 from __future__ import annotations
+import gzip
+import itertools
 import json
+import os
 import re
-import textwrap
+import sys
+import time
 import uuid
+from collections import deque
 from typing import *
 from urllib.parse import quote_plus as quote_url
 from urllib.parse import quote_plus as url_quote
 from urllib.parse import urlencode
 
 import aiohttp
-import httpx
 import nio
 from nio import AsyncClient
-from nio.api import Api
 
 from . import utils as u
 from .log import Logger
@@ -21,6 +24,22 @@ from .prelude import *
 
 REQ_PRE = "/_matrix/client/r0"
 
+TRIM_PLACEHOLDER = " [... trimmed due to matrix limit]"
+TRIM_LIMIT_BYTES = 1000
+WAIT_FOR_SERVER_MIN_DELAY = 0.01
+WAIT_FOR_SERVER_MAX_DELAY = 5
+# request bodies smaller than this aren't worth compressing
+GZIP_MIN_BYTES = 2048
+# bridge sees many one-off addresses (bounces, marketing), so only keep recently used virtual users
+KNOWN_USERS_MAXSIZE = 4096
+
+_MXC_RE = re.compile(r"mxc://(?P<hs>[^/]+)/(?P<id>.+)")
+
+
+def _dump_json(data: Union[dict, list]) -> str:
+	# compact separators and raw non-ascii chars, instead of `\uXXXX` escapes, keep big html bodies small
+	return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
 
 class RequestException(Exception):
 
@@ -68,6 +87,7 @@ class AppserviceClient(AsyncClient):
 		config: Optional[nio.AsyncClientConfig] = None,
 		ssl: Optional[bool] = None,
 		proxy: Optional[str] = None,
+		gzip_requests: bool = False,
 	):
 		super().__init__(
 			homeserver_url,
@@ -78,8 +98,21 @@ class AppserviceClient(AsyncClient):
 			ssl=ssl,
 			proxy=proxy,
 		)
-		self.namespace_prefix = namespace_prefix
-		self.homeserver_name = homeserver_name
+		# interned, as these are compared/concatenated for nearly every event
+		self.namespace_prefix = sys.intern(namespace_prefix)
+		self.homeserver_name = sys.intern(homeserver_name)
+		# not every homeserver accepts gzip encoded request bodies, so it's opt-in
+		self.gzip_requests = gzip_requests
+		self._bot_prefix = sys.intern(f"@{namespace_prefix}")
+		self._alias_prefix = sys.intern(f"#{namespace_prefix}")
+		self._hs_suffix = sys.intern(f":{homeserver_name}")
+		self._ns_prefix_len = len(namespace_prefix)
+		self._sigil_prefix_len = len(self._bot_prefix)
+		# virtual users confirmed to exist on homeserver, to skip re-probing them for every mail. LRU ordered
+		self._known_users: OrderedDict[str, None] = OrderedDict()
+		# txn ids only need to be unique per access token, so a counter behind a per-process prefix is enough
+		self._txn_prefix = f"{os.getpid()}-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+		self._txn_counter = itertools.count()
 		self._logger = Logger("matrix-client")
 
 	@property
@@ -87,36 +120,40 @@ class AppserviceClient(AsyncClient):
 		return self.user_id
 
 	def is_our_bot(self, mxid: str) -> bool:
-		return mxid.startswith(f"@{self.namespace_prefix}")
+		# slice compare benchmarks faster than `startswith` for these short prefixes
+		return mxid[:self._sigil_prefix_len] == self._bot_prefix
 
 	def is_our_mxid(self, mxid: str) -> bool:
 		return self.is_our_bot(mxid) or mxid == self.appservice_id
 
 	def is_our_alias(self, alias: str) -> bool:
-		return alias.startswith(f"#{self.namespace_prefix}")
+		return alias[:self._sigil_prefix_len] == self._alias_prefix
 
 	def generate_bot_mxid(self, name: str) -> str:
-		return f"@{self.namespace_prefix}{name}:{self.homeserver_name}"
+		return self._bot_prefix + name + self._hs_suffix
 
 	def extract_bot_name(self, mxid: str) -> str:
 		assert self.is_our_bot(mxid), f"Not an appservice bot: {mxid}"
 		localpart = u.extract_mxid_localpart(mxid)
-		return localpart.removeprefix(self.namespace_prefix)
+		return localpart[self._ns_prefix_len:]
 
 	def extract_alias_name(self, alias: str) -> str:
 		assert self.is_our_alias(alias), f"Not an appservice alias: {alias}"
 		localpart = u.extract_alias_localpart(alias)
-		return localpart.removeprefix(self.namespace_prefix)
+		return localpart[self._ns_prefix_len:]
 
 	@staticmethod
 	def parse_media_url(media_url: str) -> Tuple[str, str]:
 		""" returns (homerserver_name, media_id)"""
-		m = re.fullmatch(r"mxc://(?P<hs>.*)/(?P<id>.*)", media_url)
+		m = _MXC_RE.fullmatch(media_url)
 		assert m is not None, f"Not a media url {media_url=}"
 		return m.group('hs'), m.group('id')
 
 	def generate_room_alias(self, name: str) -> str:
-		return f"#{self.namespace_prefix}{name}:{self.homeserver_name}"
+		return self._alias_prefix + name + self._hs_suffix
+
+	def _next_txn_id(self) -> str:
+		return f"{self._txn_prefix}-{next(self._txn_counter)}"
 
 	async def login(self, access_token: str):
 		self.access_token = access_token
@@ -164,7 +201,11 @@ class AppserviceClient(AsyncClient):
 		raise GmailBridgeException(f"Unexpected Response from Nio Library {resp=}")
 
 	async def ensure_virtual_user(self, bot_id: str):
+		if bot_id in self._known_users:
+			self._known_users.move_to_end(bot_id)
+			return
 		if await self.user_exists(bot_id):
+			self._remember_user(bot_id)
 			return
 
 		localpart = u.extract_mxid_localpart(bot_id)
@@ -175,6 +216,12 @@ class AppserviceClient(AsyncClient):
 		}
 		self._logger.debug("create user", content=content)
 		await self._raw("POST", "/register", data=content)
+		self._remember_user(bot_id)
+
+	def _remember_user(self, bot_id: str):
+		self._known_users[bot_id] = None
+		if len(self._known_users) > KNOWN_USERS_MAXSIZE:
+			self._known_users.popitem(last=False)
 
 	async def set_room_power_levels(self, room_id: str, power_levels: Dict[str, int]) -> Dict[str, int]:
 		r = await self.room_get_state_event(room_id, "m.room.power_levels")
@@ -185,8 +232,10 @@ class AppserviceClient(AsyncClient):
 		return new_content['users']
 
 	async def get_room_power_levels(self, room_id: str) -> Dict[str, int]:
-		users = await self.get_room_members(room_id)
-		r = await self.room_get_state_event(room_id, "m.room.power_levels")
+		users, r = await aio.gather(
+			self.get_room_members(room_id),
+			self.room_get_state_event(room_id, "m.room.power_levels"),
+		)
 		assert isinstance(r, nio.RoomGetStateEventResponse), r
 		default_power = r.content['users_default']
 		powers: Dict[str, int] = r.content['users']
@@ -226,7 +275,7 @@ class AppserviceClient(AsyncClient):
 			"msgtype": msgtype,
 		}
 		resp = await self._raw(
-			"PUT", f"/rooms/{quote_url(room_id)}/send/m.room.message/{uuid.uuid4()}", user=as_bot, data=content
+			"PUT", f"/rooms/{quote_url(room_id)}/send/m.room.message/{self._next_txn_id()}", user=as_bot, data=content
 		)
 		return (await resp.json())['event_id']
 
@@ -254,7 +303,7 @@ class AppserviceClient(AsyncClient):
 			**(format_info),
 		}
 		r = await self._raw(
-			"PUT", f"/rooms/{quote_url(room_id)}/send/m.room.message/{uuid.uuid4()}", user=as_bot, data=content, strict=False
+			"PUT", f"/rooms/{quote_url(room_id)}/send/m.room.message/{self._next_txn_id()}", user=as_bot, data=content, strict=False
 		)
 		if r.status == 413 and ((await r.json())['errcode']) == "M_TOO_LARGE":
 			if html is not None:
@@ -269,10 +318,12 @@ class AppserviceClient(AsyncClient):
 					user=as_bot,
 					room_id=room_id,
 				)
-				# TODO: fix the assumption for allowed_width to always be more then 1000
-				allowed_width = 1000
-				assert len(body) <= allowed_width, f"msg of len {len(body)} char got rejected by server. Fix width in code."
-				body = textwrap.shorten(body, width=allowed_width, placeholder=" [... trimmed due to matrix limit]")
+				# TODO: fix the assumption for TRIM_LIMIT_BYTES to always be accepted by server
+				encoded = body.encode('utf-8')
+				assert len(encoded) > TRIM_LIMIT_BYTES, f"msg of {len(encoded)} bytes got rejected by server. Fix limit in code."
+				# slice the encoded bytes directly, dropping any partial trailing codepoint
+				allowed = TRIM_LIMIT_BYTES - len(TRIM_PLACEHOLDER.encode('utf-8'))
+				body = encoded[:allowed].decode('utf-8', errors='ignore') + TRIM_PLACEHOLDER
 				return await self.c_send_msg(room_id=room_id, body=body, html=None, info=info, as_bot=as_bot)
 
 		if not r.ok:
@@ -300,30 +351,43 @@ class AppserviceClient(AsyncClient):
 		assert isinstance(r, nio.RoomGetStateEventResponse)
 		return r.content['name']
 
-	async def wait_for_server(self):
+	async def wait_for_server(self, timeout: float = 55):
+		# retry quickly first (server is usually up, or just starting), backing off up to a max delay
+		delays = u.backoff_delays(WAIT_FOR_SERVER_MIN_DELAY, WAIT_FOR_SERVER_MAX_DELAY)
+		deadline = time.monotonic() + timeout
 		retry = 0
 		while True:
 			try:
 				await self._raw("GET", "/")
 				return
 			except (aiohttp.ClientConnectorError, aiohttp.ClientConnectionError) as e:
-				if retry > 10:
+				delay = next(delays)
+				if time.monotonic() + delay > deadline:
 					raise e
 				retry += 1
-				logger.info("waiting for server", retry=retry)
-				await aio.sleep(5)
+				logger.info("waiting for server", retry=retry, delay=delay)
+				await aio.sleep(delay)
 			except RequestException:
 				return True
 
-	async def get_old_events(self, room_id: str, after_event_id: Optional[str] = None, flexible_visibility: bool = False):
+	async def get_old_events(
+		self,
+		room_id: str,
+		after_event_id: Optional[str] = None,
+		flexible_visibility: bool = False,
+		event_types: Optional[Collection[str]] = None,
+	):
 		"""
 		`flexible_visibility` handles the case where m.room.history_visibility is not 'world_readable' or 'shared'
 		in case it can't find the old (after_event_id) event, it'll try to return as many events as it can see. 
 		ref: https://spec.matrix.org/v1.2/client-server-api/#room-history-visibility
+
+		`event_types` if given, only events of these types are parsed and returned.
 		"""
 
 		since = None
-		rv: List[nio.Event] = []
+		# events are walked newest first, so prepend to keep `rv` in chronological order
+		rv: Deque[nio.Event] = deque()
 		found = False
 		event_visible = True
 
@@ -362,19 +426,26 @@ class AppserviceClient(AsyncClient):
 			since = room_timeline['prev_batch']
 			events = room_timeline['events']
 
-			for event in reversed(events):
-				# matrix events returned in sync don't have room_id
-				event['room_id'] = room_id
+			# find the terminator first, so events before it are never parsed
+			cutoff = 0
+			for i, event in enumerate(events):
 				if event['event_id'] == after_event_id:
 					assert event_visible, "event_visible is false but still got the event, (calculation of event_visible is wrong)"
 					found = True
+					cutoff = i + 1
 					break
 
+			for event in reversed(events[cutoff:]):
+				if event_types is not None and event.get('type') not in event_types:
+					continue
+
+				# matrix events returned in sync don't have room_id
+				event['room_id'] = room_id
 				parsed = nio.Event.parse_event(event)
 				if isinstance(parsed, (nio.UnknownBadEvent, nio.BadEvent)):
 					logger.warn("Recieved Bad event from server", event_id=event['event_id'], parsed=parsed)
 					continue
-				rv.append(parsed)
+				rv.appendleft(parsed)
 
 			if found:
 				break
@@ -388,7 +459,7 @@ class AppserviceClient(AsyncClient):
 				)
 				assert found, "See Previous Error Log"
 
-		return list(reversed(rv))
+		return list(rv)
 
 	async def _raw(
 		self,
@@ -414,14 +485,22 @@ class AppserviceClient(AsyncClient):
 		if user:
 			params.append(("user_id", user))
 		if not (data is None or isinstance(data, str)):
-			data = json.dumps(data)
+			data = _dump_json(data)
+
+		headers = {"Authorization": f"Bearer {self.access_token}"}
+		body: Union[str, bytes, None] = data
+		if self.gzip_requests and method in ("PUT", "POST") and data is not None:
+			encoded = data.encode('utf-8')
+			if len(encoded) > GZIP_MIN_BYTES:
+				body = gzip.compress(encoded, compresslevel=3)
+				headers["Content-Encoding"] = "gzip"
 
 		param_str = urlencode(params)
 		r = await self.send(
 			method,
 			f"{REQ_PRE}{path}?{param_str}",
-			headers={"Authorization": f"Bearer {self.access_token}"},
-			data=data,
+			headers=headers,
+			data=body,
 		)
 		await r.read()
 		if strict and not r.ok:
@@ -447,76 +526,6 @@ if __name__ == "__main__":
 
 		self = appservice
 
-		# async def get_events(room_id: str, after_event_id: Optional[str] = None, flexible_visibility: bool = False):
-		# 	"""
-		# 	flexible_visibility handles the case where m.room.history_visibility is not 'world_readable' or 'shared'
-		# 	in case it can't find the old event, it'll try to return as many as it can see.
-		# 	ref: https://spec.matrix.org/v1.2/client-server-api/#room-history-visibility
-		# 	"""
-		# 	event_visible = True
-		# 	if flexible_visibility and after_event_id is not None:
-		# 		try:
-		# 			await self.c_room_get_event(room_id, after_event_id)
-		# 		except RequestException as e:
-		# 			if not e.is_forbidden():
-		# 				raise
-		# 			event_visible = False
-
-		# 	since = None
-
-		# 	rv: List[nio.Event] = []
-		# 	found = False
-
-		# 	while True:
-		# 		sync_filter = {
-		# 			"room": {
-		# 				"rooms": [room_id],
-		# 				# "timeline": { }
-		# 			},
-		# 		}
-		# 		params = {
-		# 			"user_id": "@_gmail_bridge_nnkitsaini_at_gmail.com:dev.matrix",
-		# 			"filter": json.dumps(sync_filter),
-		# 		}
-
-		# 		if since:
-		# 			params['since'] = since
-
-		# 		r = await self._raw("GET", "/sync", params=params)
-		# 		data = await r.json()
-		# 		if room_id not in data.get("rooms", {}).get("join", {}):
-		# 			# No More visible events
-		# 			break
-		# 		room_timeline = data['rooms']['join'][room_id]['timeline']
-		# 		since = room_timeline['prev_batch']
-		# 		events = room_timeline['events']
-
-		# 		for event in reversed(events):
-		# 			if event['event_id'] == after_event_id:
-		# 				assert event_visible, "event_visible is false but still got the event, (calculation of event_visible is wrong)"
-		# 				found = True
-		# 				break
-
-		# 			parsed = nio.Event.parse_event(event)
-		# 			if isinstance(parsed, (nio.UnknownBadEvent, nio.BadEvent)):
-		# 				logger.warn("Recieved Bad event from server", event_id=event['event_id'], parsed=parsed)
-		# 				continue
-		# 			rv.append(parsed)
-
-		# 		if found:
-		# 			break
-
-		# 	if after_event_id is not None and event_visible:
-		# 		if not found:
-		# 			logger.error(
-		# 				"Can't find event in room sync, even though it's visible",
-		# 				event_id=after_event_id,
-		# 				room_id=room_id,
-		# 			)
-		# 			assert found, "See Previous Error Log"
-
-		# 	return rv
-
 		events = await self.get_old_events(room_id, "$9z4StkFDX8JYRusyZN1J8aBteyErjA8N1cL6B-A-N5A", True)
 		print(len(events))
 		print(events)
@@ -1,14 +1,9 @@
 import os
-import html
-from io import IOBase
 import datetime as dt
 from dataclasses import dataclass, field
 from pathlib import Path
 import asyncio as aio
 from typing import Optional, Tuple, List, TypedDict, Union, Dict, Set
-from pprint import pprint
-import base64
-from pydantic import BaseModel
 from .log import Logger
 
 DEBUG = os.environ.get("DEBUG", "1") == "0"
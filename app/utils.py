@@ -1,95 +1,122 @@
 import asyncio as aio
+import os
+import random
 import sys
 import re
-from dataclasses import dataclass, field
+from contextlib import contextmanager
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import mkstemp
 
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
 from .prelude import logger
 
-email_re = re.compile(
-	r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*@(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?"
-)
+_EMAIL_PATTERN = r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*@(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?"
+email_re = re.compile(r"\A" + _EMAIL_PATTERN + r"\Z", re.IGNORECASE | re.ASCII)
+# one address per line, for validating many addresses in a single regex pass
+_email_lines_re = re.compile(r"^" + _EMAIL_PATTERN + r"$", re.IGNORECASE | re.MULTILINE | re.ASCII)
+_email_match = email_re.match
 
 AT_PLACEHOLDER = "_at_"
 
 
 def extract_email(mxid: str, namespace_prefix: str) -> str:
 	localpart = extract_mxid_localpart(mxid)
-	localpart = localpart.replace(namespace_prefix, "", 1)
+	assert localpart.startswith(namespace_prefix), mxid
+	localpart = localpart[len(namespace_prefix):]
 	return email_desanitize(localpart)
 
 
-# def is_valid_email_mxid(mxid: str) -> bool:
-# 	senatized_email = extract_mxid_localpart(mxid)
-# 	if "_at_" not in senatized_email:
-# 		return False
-# 	return is_valid_email(email_desanitize(senatized_email))
+def split_matrix_id(val: str) -> Tuple[str, str, str]:
+	""" returns (sigil, localpart, server_name) of a mxid or room alias """
+	# localparts can't contain ":" but server names can (port), so split on the first ":"
+	head, sep, server_name = val.partition(":")
+	assert sep and head[:1] in ('#', '@'), val
+	return head[0], head[1:], server_name
 
 
 def extract_alias_localpart(alias: str) -> str:
-	match = re.fullmatch(r"#(.*):(.*?)", alias)
-	assert match is not None, match
-	return match.group(1)
+	sigil, localpart, _ = split_matrix_id(alias)
+	assert sigil == '#', alias
+	return localpart
 
 
 def extract_mxid_localpart(mxid: str) -> str:
-	match = re.fullmatch(r"@(.*):(.*?)", mxid)
-	assert match is not None, match
-	return match.group(1)
+	sigil, localpart, _ = split_matrix_id(mxid)
+	assert sigil == '@', mxid
+	return localpart
 
 
 def extract_localpart(val: str) -> str:
-	assert val[0] in ['#', '@']
-	if val[0] == '@':
-		return extract_mxid_localpart(val)
-	else:
-		return extract_alias_localpart(val)
+	return split_matrix_id(val)[1]
 
 
 def email_sanitize(email: str) -> str:
 	return email.replace("@", AT_PLACEHOLDER)
 
 def try_email_desanitize(sanitized_email: str) -> Optional[str]:
-	if AT_PLACEHOLDER not in sanitized_email:
+	head, sep, tail = sanitized_email.rpartition(AT_PLACEHOLDER)
+	if not sep:
 		return None
-	index = sanitized_email.rindex(AT_PLACEHOLDER)
-	email = sanitized_email[:index] + "@" + sanitized_email[index + len(AT_PLACEHOLDER):]
+	email = head + "@" + tail
 	if not is_valid_email(email):
 		return None
 	return email
 
 def email_desanitize(sanitized_email: str) -> str:
-	index = sanitized_email.rindex(AT_PLACEHOLDER)
-	email = sanitized_email[:index] + "@" + sanitized_email[index + len(AT_PLACEHOLDER):]
-	return email
+	head, sep, tail = sanitized_email.rpartition(AT_PLACEHOLDER)
+	assert sep, f"Not a sanitized email: {sanitized_email}"
+	return head + "@" + tail
 
 
-def is_valid_email(email: str) -> bool:
-	return email_re.fullmatch(email.lower()) is not None
+# RFC 5321 limit on length of an address
+MAX_EMAIL_LENGTH = 254
+
 
+def is_valid_email(email: str) -> bool:
+	# cheap rejects before running the regex
+	at = email.find("@")
+	if at < 1 or at == len(email) - 1 or len(email) > MAX_EMAIL_LENGTH:
+		return False
+	return _email_match(email) is not None
+
+
+def filter_valid_emails(emails: Iterable[str]) -> List[str]:
+	""" returns valid emails from `emails`, in order. Same as filtering with `is_valid_email` """
+	candidates = [
+		e for e in emails
+		if "\n" not in e and 0 < e.find("@") < len(e) - 1 and len(e) <= MAX_EMAIL_LENGTH
+	]
+	return [m.group(0) for m in _email_lines_re.finditer("\n".join(candidates))]
+
+
+@contextmanager
+def named_temp_path() -> Iterator[Path]:
+	""" Yields a Path instead of file object. File is removed on exit """
+	fd, name = mkstemp()
+	os.close(fd)
+	path = Path(name)
+	try:
+		yield path
+	finally:
+		path.unlink(missing_ok=True)
 
-@dataclass
-class NamedTempFile:
-	""" Returns a Path instead of file object """
-	path: Path = field(init=False)
 
-	def __post_init__(self):
-		file = NamedTemporaryFile(delete=False)
-		self.path = Path(file.name)
+def backoff_delays(initial: float = 0.01, cap: float = 0.3, jitter: float = 0.2) -> Iterator[float]:
+	""" Infinite exponential backoff delays, each randomly scaled by +-`jitter` """
+	delay = initial
+	while True:
+		yield delay * (1 + random.uniform(-jitter, jitter))
+		delay = min(delay * 2, cap)
 
-	def __enter__(self, *args) -> Path:
-		return self.path
 
-	def __exit__(self, *args):
-		self.path.unlink()
+# `sys.exception` is 3.11+
+_current_exception = getattr(sys, "exception", lambda: sys.exc_info()[1])
 
 
 def custom_exception_handler(loop, context) -> None:
 	# first, handle with default handler
 	loop.default_exception_handler(context)
-	include_stack = sys.exc_info()[0] == None
+	include_stack = _current_exception() is None
 	logger.exception("unhandled exception occurred", context=context, stack_info=include_stack)
 
 
@@ -0,0 +1,49 @@
+import pytest
+from app.config import *
+from concurrent.futures import ThreadPoolExecutor
+
+
+@pytest.mark.asyncio
+async def test_overridden_config():
+	first = BridgeConfig.example_config()
+	second = BridgeConfig.example_config()
+	second.PORT = first.PORT + 1
+
+	async def port_with(config: BridgeConfig) -> int:
+		with overridden_config(config):
+			await aio.sleep(0)
+			return get_config().PORT
+
+	# each task sees its own override
+	ports = await aio.gather(port_with(first), port_with(second))
+	assert ports == [first.PORT, second.PORT]
+
+	with overridden_config(first):
+		with overridden_config(second):
+			assert get_config() is second
+		assert get_config() is first
+
+
+def test_override_config():
+	config = BridgeConfig.example_config()
+
+	async def set_override():
+		override_config(config)
+
+	try:
+		# override set inside a finished coroutine (as in async fixtures) stays visible
+		loop = aio.new_event_loop()
+		loop.run_until_complete(set_override())
+		loop.close()
+		assert get_config() is config
+
+		# and from other threads
+		with ThreadPoolExecutor(1) as pool:
+			assert pool.submit(get_config).result() is config
+
+		scoped = BridgeConfig.example_config()
+		with overridden_config(scoped):
+			assert get_config() is scoped
+		assert get_config() is config
+	finally:
+		override_config(None)
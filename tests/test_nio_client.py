@@ -0,0 +1,166 @@
+import pytest
+import app.nio_client as nio_client
+from app.nio_client import *
+
+ROOM_ID = "!room:example.com"
+
+
+def _msg(event_id: str) -> dict:
+	return {
+		"type": "m.room.message",
+		"event_id": event_id,
+		"sender": "@a:example.com",
+		"origin_server_ts": 1,
+		"content": {
+			"msgtype": "m.text",
+			"body": event_id
+		},
+	}
+
+
+def _member(event_id: str) -> dict:
+	return {
+		"type": "m.room.member",
+		"event_id": event_id,
+		"sender": "@a:example.com",
+		"state_key": "@a:example.com",
+		"origin_server_ts": 1,
+		"content": {
+			"membership": "join"
+		},
+	}
+
+
+class _JsonResponse:
+
+	def __init__(self, data: dict, status: int = 200):
+		self._data = data
+		self.status = status
+		self.ok = status < 400
+
+	async def json(self) -> dict:
+		return self._data
+
+
+def _new_client() -> AppserviceClient:
+	return AppserviceClient(
+		homeserver_url="http://localhost",
+		homeserver_name="example.com",
+		namespace_prefix="_gmail_bridge_",
+	)
+
+
+def _client_with_pages(monkeypatch, pages: List[List[dict]]) -> AppserviceClient:
+	""" `pages` newest first, each page in chronological order (as /sync returns them) """
+	client = _new_client()
+
+	async def _raw(method, path, params=None, **kwargs):
+		assert (method, path) == ("GET", "/sync")
+		since = params.get('since')
+		idx = 0 if since is None else int(since)
+		if idx >= len(pages):
+			return _JsonResponse({"rooms": {"join": {}}})
+		timeline = {"events": [dict(e) for e in pages[idx]], "prev_batch": str(idx + 1)}
+		return _JsonResponse({"rooms": {"join": {ROOM_ID: {"timeline": timeline}}}})
+
+	monkeypatch.setattr(client, "_raw", _raw)
+	return client
+
+
+def _ids(events: List[nio.Event]) -> List[str]:
+	return [e.event_id for e in events]
+
+
+@pytest.mark.asyncio
+async def test_get_old_events(monkeypatch):
+	older = [_msg("$1"), _member("$2"), _msg("$3")]
+	newer = [_msg("$4"), {"event_id": "$bad"}, _member("$5"), _msg("$6")]
+	client = _client_with_pages(monkeypatch, [newer, older])
+
+	# no terminator, all pages are read, bad events are skipped
+	events = await client.get_old_events(ROOM_ID)
+	assert _ids(events) == ["$1", "$2", "$3", "$4", "$5", "$6"]
+	assert all(e.source.get('room_id') == ROOM_ID for e in events)
+
+	# terminator in the older page
+	assert _ids(await client.get_old_events(ROOM_ID, after_event_id="$2")) == ["$3", "$4", "$5", "$6"]
+	# terminator as the newest event
+	assert _ids(await client.get_old_events(ROOM_ID, after_event_id="$6")) == []
+
+	events = await client.get_old_events(ROOM_ID, event_types={"m.room.message"})
+	assert _ids(events) == ["$1", "$3", "$4", "$6"]
+	events = await client.get_old_events(ROOM_ID, after_event_id="$3", event_types={"m.room.member"})
+	assert _ids(events) == ["$5"]
+
+	# terminator never shows up, even though it's visible
+	with pytest.raises(AssertionError):
+		await client.get_old_events(ROOM_ID, after_event_id="$missing")
+
+
+@pytest.mark.asyncio
+async def test_ensure_virtual_user_lru(monkeypatch):
+	client = _new_client()
+	probed: List[str] = []
+
+	async def user_exists(mxid: str) -> bool:
+		probed.append(mxid)
+		return True
+
+	monkeypatch.setattr(client, "user_exists", user_exists)
+	monkeypatch.setattr(nio_client, "KNOWN_USERS_MAXSIZE", 2)
+
+	for mxid in ["@a:example.com", "@b:example.com", "@a:example.com", "@c:example.com"]:
+		await client.ensure_virtual_user(mxid)
+	# "@a" was used recently, so "@b" got evicted
+	assert probed == ["@a:example.com", "@b:example.com", "@c:example.com"]
+	assert list(client._known_users) == ["@a:example.com", "@c:example.com"]
+
+	await client.ensure_virtual_user("@b:example.com")
+	assert probed[-1] == "@b:example.com"
+	assert len(client._known_users) == 2
+
+
+def _client_with_size_limit(monkeypatch, limit: int) -> Tuple[AppserviceClient, List[dict]]:
+	""" server rejects html bodies and bodies over `limit` bytes as too large """
+	client = _new_client()
+	sent: List[dict] = []
+
+	async def _raw(method, path, params=None, user=None, data=None, strict=True):
+		assert method == "PUT" and "/send/m.room.message/" in path
+		sent.append(data)
+		if "formatted_body" in data or len(data['body'].encode('utf-8')) > limit:
+			return _JsonResponse({"errcode": "M_TOO_LARGE"}, status=413)
+		return _JsonResponse({"event_id": "$sent"})
+
+	monkeypatch.setattr(client, "_raw", _raw)
+	return client, sent
+
+
+@pytest.mark.asyncio
+async def test_c_send_msg_too_large(monkeypatch):
+	client, sent = _client_with_size_limit(monkeypatch, TRIM_LIMIT_BYTES)
+	# 3 byte "€" chars, so the byte limit falls inside one of them
+	body = "a" + "€" * 1000
+	assert await client.c_send_msg(ROOM_ID, body, html="<p>big</p>") == "$sent"
+
+	# html first, then plain body, then trimmed body
+	assert len(sent) == 3
+	assert sent[0]['formatted_body'] == "<p>big</p>" and sent[0]['body'] == body
+	assert "formatted_body" not in sent[1] and sent[1]['body'] == body
+	trimmed = sent[2]['body']
+	assert "formatted_body" not in sent[2]
+	assert len(trimmed.encode('utf-8')) <= TRIM_LIMIT_BYTES
+	assert trimmed.endswith(TRIM_PLACEHOLDER)
+	# partial "€" at the cut is dropped, not replaced
+	kept = trimmed[:-len(TRIM_PLACEHOLDER)]
+	assert kept == "a" + "€" * ((TRIM_LIMIT_BYTES - len(TRIM_PLACEHOLDER) - 1) // 3)
+	assert "\ufffd" not in kept
+
+
+@pytest.mark.asyncio
+async def test_c_send_msg_too_large_under_limit(monkeypatch):
+	# server limit is below ours, trimming can't help
+	client, sent = _client_with_size_limit(monkeypatch, 10)
+	with pytest.raises(AssertionError):
+		await client.c_send_msg(ROOM_ID, "x" * 100, html="<p>x</p>")
+	assert len(sent) == 2
@@ -0,0 +1,78 @@
+import pytest
+from app.utils import *
+
+
+def test_extract_localpart():
+	assert extract_mxid_localpart("@_gmail_bridge_a_at_b.com:dev.matrix") == "_gmail_bridge_a_at_b.com"
+	assert extract_alias_localpart("#thread.a_at_b.com:dev.matrix") == "thread.a_at_b.com"
+	# server name with port
+	assert extract_mxid_localpart("@user:localhost:8008") == "user"
+	assert extract_localpart("@user:localhost") == "user"
+	assert extract_localpart("#room:localhost") == "room"
+
+	assert split_matrix_id("@user:localhost:8008") == ("@", "user", "localhost:8008")
+
+	with pytest.raises(AssertionError):
+		extract_mxid_localpart("#room:localhost")
+	with pytest.raises(AssertionError):
+		extract_localpart("room:localhost")
+	with pytest.raises(AssertionError):
+		extract_alias_localpart("#room")
+
+
+def test_is_valid_email():
+	assert is_valid_email("a@gmail.com")
+	assert is_valid_email("Hk8128@PM.me")
+	assert not is_valid_email("b a@gmail.com")
+	assert not is_valid_email("b a@gmail")
+	assert not is_valid_email("gmail.com")
+	assert not is_valid_email("@gmail.com")
+	assert not is_valid_email("a@")
+	assert not is_valid_email("")
+	assert not is_valid_email("a" * 250 + "@b.com")
+	# non-ascii letters that case fold to ascii ones
+	assert not is_valid_email("ſ@gmail.com")
+	assert not is_valid_email("ı@x.com")
+	assert not is_valid_email("İ@x.com")
+	assert not is_valid_email("a@\u212a.com")  # kelvin sign
+
+
+def test_email_sanitize():
+	assert email_sanitize("ak@iffmail.com") == "ak_at_iffmail.com"
+	assert email_desanitize("ak_at_iffmail.com") == "ak@iffmail.com"
+	# placeholder in the local part, only the last one is the `@`
+	assert email_desanitize(email_sanitize("a_at_b@c.com")) == "a_at_b@c.com"
+	assert try_email_desanitize("ak_at_iffmail.com") == "ak@iffmail.com"
+	assert try_email_desanitize("akiffmail.com") is None
+	assert try_email_desanitize("a b_at_iffmail.com") is None
+
+
+def test_extract_email():
+	assert extract_email("@_gmail_bridge_a_at_b.com:dev.matrix", "_gmail_bridge_") == "a@b.com"
+	with pytest.raises(AssertionError):
+		extract_email("@a_at_b.com:dev.matrix", "_gmail_bridge_")
+
+
+def test_named_temp_path():
+	with named_temp_path() as path:
+		assert path.is_file()
+		path.write_bytes(b"data")
+	assert not path.exists()
+
+	# caller already removed the file
+	with named_temp_path() as path:
+		path.unlink()
+
+
+def test_filter_valid_emails():
+	emails = ["a@gmail.com", "b a@gmail.com", "", "B@Pm.me", "gmail.com", "a@b.com\nc@d.com", "x@y.com ", "ſ@gmail.com", "ı@x.com", "c@d.org"]
+	assert filter_valid_emails(emails) == [e for e in emails if is_valid_email(e)]
+	assert filter_valid_emails(emails) == ["a@gmail.com", "B@Pm.me", "c@d.org"]
+	assert filter_valid_emails([]) == []
+
+
+def test_backoff_delays():
+	delays = backoff_delays(initial=0.01, cap=0.3, jitter=0.2)
+	expected = [0.01, 0.02, 0.04, 0.08, 0.16, 0.3, 0.3]
+	for base in expected:
+		assert base * 0.8 <= next(delays) <= base * 1.2